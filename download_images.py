@@ -7,40 +7,82 @@ target.csvを読み込み、2列目の画像URLをdownloads/に保存するス
 from __future__ import annotations
 
 import argparse
+import asyncio
 import csv
+import email.utils
+import hashlib
+import http.client
+import io
+import json
 import mimetypes
+import mmap
 import os
-import re
+import ssl
+import struct
+import sys
+import threading
 import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Iterator, Optional, TextIO, Union
 from urllib.error import URLError, HTTPError, ContentTooShortError
-from urllib.parse import urlparse
-from urllib.request import Request, urlopen
+from urllib.parse import ParseResult, quote, urljoin, urlparse
+from urllib.request import Request, getproxies, urlopen
 
 
 CSV_PATH = Path("target.csv")
 DOWNLOAD_DIR = Path("downloads")
 LOG_DIR = Path("logs")
 SUCCESS_LOG = LOG_DIR / "success.log"
+SUCCESS_INDEX = LOG_DIR / "success.idx"  # success.logのname_keyを8バイトずつ並べた索引
 FAILED_LOG = LOG_DIR / "failed.log"
+HASH_INDEX = DOWNLOAD_DIR / ".hash_index.json"  # 本文のハッシュ値 -> 保存ファイル名
+META_FILE = DOWNLOAD_DIR / ".meta.json"  # URL -> 前回応答のETag/Last-Modifiedと保存ファイル名
 USER_AGENT = "image-downloader/1.0 (canac0.d0.s0lh1de.m24w@gmail.com)"
-DELAY_SECONDS = 0.5  # サイト負荷軽減のための待機時間（秒）
-BATCH_PAUSE_EVERY = 50  # この件数ごとに追加の待機を入れる
-BATCH_PAUSE_SECONDS = 5  # 追加待機の長さ（秒）
-INVALID_CHARS = re.compile(r'[\\\\/:*?"<>|]')
+REQUEST_TIMEOUT = 30  # 接続・読み込みのタイムアウト（秒）
+MAX_REDIRECTS = 5  # リダイレクトを追跡する最大回数
+RATE_PER_SECOND = 2.0  # サイト負荷軽減のための平均リクエスト数（件/秒）
+RATE_BURST = 5  # 一時的に連続して送ってよいリクエスト数
+MAX_RETRIES = 3  # 429/5xx応答や通信エラー時の再試行回数
+RETRY_BACKOFF_SECONDS = 0.5  # 再試行待機の初期値（秒）。試行ごとに倍にする
+MAX_RETRY_AFTER_SECONDS = 60  # Retry-Afterヘッダーに従って待機する最大秒数
+CHUNK_SIZE = 64 * 1024  # レスポンスを読み込む単位（バイト）
+WRITE_BUFFER_SIZE = 1 << 20  # ファイル書き込みのバッファサイズ（バイト）
+FADVISE_MIN_BYTES = 1 << 20  # これ以上のサイズの保存ファイルだけページキャッシュから外す（バイト）
+MAX_CONCURRENCY = 8  # 同時ダウンロード数の上限
+MAX_PER_HOST = 4  # 同一ホストへの同時接続数の上限
+LOG_BUFFER_SIZE = 1 << 16  # ログ書き込みのバッファサイズ（バイト）
+SORTED_KEYS_MIN_LINES = 10_000  # success.logがこの行数以上ならソート済み配列で保持する
+KEY_STRUCT = struct.Struct("<Q")
+INVALID_CHARS = str.maketrans(dict.fromkeys('\\/:*?"<>|', "_"))
 
 
 def sanitize_filename(name: str) -> str:
     """ファイル名として問題になる文字を置換する。"""
-    cleaned = INVALID_CHARS.sub("_", name).strip()
+    cleaned = name.translate(INVALID_CHARS).strip()
     return cleaned or "unnamed"
 
 
-def guess_extension(url: str, content_type: Optional[str]) -> str:
-    """URLかContent-Typeから拡張子を推定する。"""
-    parsed = urlparse(url)
-    url_ext = Path(parsed.path).suffix
+def url_filename(url_path: str) -> str:
+    """URLのパス部分から末尾のファイル名を取り出す（Path(url_path).name相当）。"""
+    return url_path.rstrip("/").rpartition("/")[2]
+
+
+def split_ext(filename: str) -> tuple[str, str]:
+    """ファイル名をベース名と拡張子に分ける（Path.stem/Path.suffix相当）。"""
+    base, dot, ext = filename.rpartition(".")
+    if not dot or not base or not ext:
+        return filename, ""
+    return base, f".{ext}"
+
+
+def guess_extension(url_path: str, content_type: Optional[str]) -> str:
+    """URLのパス部分かContent-Typeから拡張子を推定する。"""
+    url_ext = split_ext(url_filename(url_path))[1]
     if url_ext:
         return url_ext
     if content_type:
@@ -50,90 +92,590 @@ def guess_extension(url: str, content_type: Optional[str]) -> str:
     return ".bin"
 
 
-def build_base_and_ext(name: str, url: str) -> tuple[str, str]:
+def build_base_and_ext(name: str, url_path: str) -> tuple[str, str]:
     """保存ファイルのベース名と拡張子を決定する（ダウンロード前に判定）。"""
-    parsed = urlparse(url)
-    orig_filename = Path(parsed.path).name
+    orig_filename = url_filename(url_path)
 
     if orig_filename:
-        safe_name = sanitize_filename(orig_filename)
-        base = Path(safe_name).stem
-        ext = Path(safe_name).suffix
+        base, ext = split_ext(sanitize_filename(orig_filename))
     else:
-        safe_name = sanitize_filename(name or "image")
-        base = safe_name
+        base = sanitize_filename(name or "image")
         ext = ""
 
     if not ext:
-        ext = guess_extension(url, None)
+        ext = guess_extension(url_path, None)
     if not ext.startswith("."):
         ext = f".{ext}"
     return base, ext
 
 
-def append_log(path: Path, message: str) -> None:
-    """ログファイルに1行追記する。"""
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("a", encoding="utf-8") as fp:
-        fp.write(f"{message}\n")
+def normalize_url(parsed: ParseResult) -> str:
+    """重複判定用にURLを正規化する（ホスト名の小文字化、末尾スラッシュとフラグメントの除去）。"""
+    return parsed._replace(
+        netloc=parsed.netloc.lower(),
+        path=parsed.path.rstrip("/") or "/",
+        fragment="",
+    ).geturl()
+
+
+def open_log(path: Path) -> TextIO:
+    """ログファイルを追記用に開く（実行中は開いたまま使い回す）。"""
+    return path.open("a", encoding="utf-8", buffering=LOG_BUFFER_SIZE)
+
+
+def append_log(fp: TextIO, message: str) -> None:
+    """ログファイルに1行追記する（書き込みはバッファされ、close時にまとめて反映される）。"""
+    fp.write(f"{message}\n")
+
+
+def record_success(ctx: DownloadContext, name: str) -> None:
+    """保存ファイル名をsuccess.logと索引ファイルの両方に追記する。"""
+    append_log(ctx.success_log, name)
+    ctx.success_index.write(KEY_STRUCT.pack(name_key(name)))
+
+
+def name_key(name: str) -> int:
+    """保存ファイル名から重複判定用の64bitハッシュ値を作る。"""
+    return int.from_bytes(
+        hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little"
+    )
 
 
-def load_logged_names(path: Path) -> set[str]:
+class SortedKeySet:
     """
-    既存のログから保存ファイル名の集合を読み込む（ファイルが無ければ空集合）。
+    name_keyのハッシュ値を、ソート済みの配列と二分探索で保持する省メモリな集合。
+    今回の実行で追加される分は件数が少ないので、別に通常のsetで持つ。
+    """
+
+    def __init__(self, keys: array) -> None:
+        self.keys = array("Q", sorted(keys))
+        self.added: set[int] = set()
+
+    def add(self, key: int) -> None:
+        self.added.add(key)
+
+    def __contains__(self, key: object) -> bool:
+        if key in self.added:
+            return True
+        if not isinstance(key, int):
+            return False
+        pos = bisect_left(self.keys, key)
+        return pos < len(self.keys) and self.keys[pos] == key
+
+
+NameSet = Union[set[int], SortedKeySet]
+
+
+def parse_logged_keys(path: Path) -> array:
+    """
+    success.logを読み込み、保存ファイル名のname_keyを並べて返す（ファイルが無ければ空）。
     過去ログがURL形式の場合も、パス部分からファイル名を抽出して併せて登録する。
     """
+    keys = array("Q")
     if not path.exists():
-        return set()
-    names: set[str] = set()
+        return keys
     with path.open("r", encoding="utf-8") as fp:
         for raw in fp:
             line = raw.strip()
             if not line:
                 continue
-            names.add(line)
-            parsed = urlparse(line)
-            url_name = Path(parsed.path).name
-            if url_name:
-                names.add(sanitize_filename(url_name))
-    return names
+            keys.append(name_key(line))
+            # 現在のログはファイル名のみなので、URL形式の行に限って文字列操作で名前を取り出す
+            if "://" in line:
+                rest = line.partition("://")[2].split("#", 1)[0].split("?", 1)[0]
+                url_name = url_filename(rest.partition("/")[2])
+                if url_name:
+                    keys.append(name_key(sanitize_filename(url_name)))
+    return keys
+
+
+def read_key_index(path: Path) -> array:
+    """索引ファイルをmmapで読み込み、リトルエンディアン8バイトのname_keyを並べて返す。"""
+    keys = array("Q")
+    with path.open("rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    # 書き込み途中で中断した端数は捨てる
+                    keys.frombytes(view[: size - size % KEY_STRUCT.size])
+    if sys.byteorder == "big":
+        keys.byteswap()
+    return keys
+
+
+def write_key_index(path: Path, keys: array) -> None:
+    """name_keyの並びを索引ファイルとして書き出す（一時ファイル経由で置き換える）。"""
+    if sys.byteorder == "big":
+        keys = array("Q", keys)
+        keys.byteswap()
+    temp_path = path.with_name(f"{path.name}.tmp")
+    with temp_path.open("wb") as fp:
+        keys.tofile(fp)
+    os.replace(temp_path, path)
+
+
+def key_index_is_fresh(log_path: Path, index_path: Path) -> bool:
+    """索引ファイルがsuccess.log以降に更新されていればTrueを返す（どちらかが無ければFalse）。"""
+    try:
+        return index_path.stat().st_mtime_ns >= log_path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def load_logged_names(log_path: Path, index_path: Path, write_index: bool = True) -> NameSet:
+    """
+    成功済みの保存ファイル名を、name_keyのハッシュ値の集合として読み込む。
+    索引ファイルがsuccess.log以降に更新されていればそれをmmapで読み込み、
+    無いか古い場合（ログを手で編集した場合など）はsuccess.logから作り直す
+    （write_indexがFalseなら、作り直した索引をファイルには書き出さない）。
+    件数がSORTED_KEYS_MIN_LINES以上の場合は、メモリ節約のためソート済み配列で保持する。
+    """
+    if key_index_is_fresh(log_path, index_path):
+        keys = read_key_index(index_path)
+    else:
+        # ソート順で書いておけば、次回以降のソートは追記分を並べ直すだけで済む
+        keys = array("Q", sorted(parse_logged_keys(log_path)))
+        if write_index:
+            write_key_index(index_path, keys)
+
+    if len(keys) < SORTED_KEYS_MIN_LINES:
+        return set(keys)
+    return SortedKeySet(keys)
+
+
+class TokenBucket:
+    """トークンバケット方式でリクエスト頻度を制限する。"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._loop = asyncio.get_running_loop()
+        self.ts = self._loop.time()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._loop.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+
+    async def acquire(self, n: float = 1) -> None:
+        """トークンがn個たまるまで待ってから消費する。"""
+        async with self._lock:
+            self._refill()
+            while self.tokens < n:
+                await asyncio.sleep((n - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n
+
+    def penalize(self) -> None:
+        """429を受けたとき、約1秒分のトークンを前借りした状態にして送信を控える。"""
+        self._refill()
+        self.tokens = min(self.tokens, -self.rate)
+
+
+@dataclass
+class DownloadContext:
+    """並列ダウンロード中に各タスクで共有する状態。"""
+
+    semaphore: asyncio.Semaphore
+    bucket: TokenBucket
+    existing_names: set[str]
+    success_log: TextIO
+    success_index: BinaryIO
+    failed_log: TextIO
+    hash_index: dict[str, str]
+    meta: dict[str, dict[str, str]]
+    host_semaphores: dict[str, asyncio.Semaphore] = field(default_factory=dict)
+
+    def host_semaphore(self, host: str) -> asyncio.Semaphore:
+        """ホストごとの同時接続数を制限するセマフォを返す。"""
+        sem = self.host_semaphores.get(host)
+        if sem is None:
+            sem = self.host_semaphores[host] = asyncio.Semaphore(MAX_PER_HOST)
+        return sem
+
+
+def scan_existing_names(directory: Path) -> set[str]:
+    """保存先フォルダ内のファイル名を一度だけ走査して集合化する。"""
+    with os.scandir(directory) as entries:
+        return {entry.name for entry in entries}
+
+
+CREATE_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+REPLACE_FLAGS = os.O_CREAT | os.O_TRUNC | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+# Linuxなど。Windows/macOSでは使わない
+HAS_FADVISE = hasattr(os, "posix_fadvise") and hasattr(os, "fdatasync")
+URL_PATH_SAFE = "/%:@!$&'()*+,;="
+URL_QUERY_SAFE = URL_PATH_SAFE + "?"
+REDIRECT_STATUSES = frozenset({301, 302, 303, 307, 308})
+SSL_CONTEXT = ssl.create_default_context()
+_thread_local = threading.local()
+
+
+def _connection_pool() -> dict[tuple[str, str], http.client.HTTPConnection]:
+    """ワーカースレッドごとの接続プール（(スキーム, ホスト) -> 接続）を返す。"""
+    pool = getattr(_thread_local, "connections", None)
+    if pool is None:
+        pool = _thread_local.connections = {}
+    return pool
+
+
+def _drop_connection(key: tuple[str, str]) -> None:
+    """使い回せなくなった接続を閉じてプールから外す。"""
+    conn = _connection_pool().pop(key, None)
+    if conn is not None:
+        conn.close()
+
+
+def _send_get(
+    key: tuple[str, str], target: str, headers: dict[str, str]
+) -> http.client.HTTPResponse:
+    """プール内の接続でGETを送り、レスポンスを返す（接続エラーはURLErrorにする）。"""
+    pool = _connection_pool()
+    scheme, netloc = key
+    for attempt in range(2):
+        conn = pool.get(key)
+        reused = conn is not None and conn.sock is not None
+        try:
+            if conn is None:
+                # ポート番号が数字でないなどの不正なURLは、ここでInvalidURLになる
+                if scheme == "https":
+                    conn = http.client.HTTPSConnection(
+                        netloc, timeout=REQUEST_TIMEOUT, context=SSL_CONTEXT
+                    )
+                else:
+                    conn = http.client.HTTPConnection(netloc, timeout=REQUEST_TIMEOUT)
+                pool[key] = conn
+            conn.request("GET", target, headers=headers)
+            return conn.getresponse()
+        except (OSError, http.client.HTTPException) as exc:
+            _drop_connection(key)
+            # 待機中にサーバー側で切断されたKeep-Alive接続なら、新しい接続で1回だけやり直す
+            if reused and attempt == 0 and isinstance(exc, ConnectionError):
+                continue
+            raise URLError(exc) from exc
+        except BaseException:
+            # 送信途中で止まった接続はプールに残すと次のリクエストが失敗するため、必ず捨てる
+            _drop_connection(key)
+            raise
+    raise AssertionError("unreachable")
+
+
+@contextmanager
+def open_url(
+    url: str, extra_headers: Optional[dict[str, str]] = None
+) -> Iterator[http.client.HTTPResponse]:
+    """
+    URLをGETして2xxのレスポンスを返す（それ以外はurlopenと同様にHTTPErrorを送出）。
+    接続はスレッドごとにホスト単位で保持し、Keep-Aliveで次のリクエストに使い回す。
+    """
+    headers = {"User-Agent": USER_AGENT, **(extra_headers or {})}
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or parsed.scheme in getproxies():
+        # プロキシ経由やhttp(s)以外のスキームはurllibに任せる
+        req = Request(url, headers=headers)
+        with urlopen(req, timeout=REQUEST_TIMEOUT) as response:
+            yield response
+        return
+
+    for _ in range(MAX_REDIRECTS + 1):
+        key = (parsed.scheme, parsed.netloc)
+        # 日本語などの非ASCII文字はパーセントエンコードしてから送る（エンコード済みの%はそのまま）
+        path = parsed.path or "/"
+        if parsed.params:
+            # urlparseがパスから切り分けた「;v=2」などのパラメーターも付け直して送る
+            path = f"{path};{parsed.params}"
+        target = quote(path, safe=URL_PATH_SAFE)
+        if parsed.query:
+            target = f"{target}?{quote(parsed.query, safe=URL_QUERY_SAFE)}"
+        response = _send_get(key, target, headers)
+        if not 200 <= response.status < 300:
+            # 本文を読み切っておけば、同じ接続を次のリクエストに使える
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                _drop_connection(key)
+            location = response.headers.get("Location")
+            if response.status in REDIRECT_STATUSES and location:
+                url = urljoin(url, location)
+                parsed = urlparse(url)
+                if parsed.scheme in ("http", "https"):
+                    continue
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        try:
+            yield response
+        finally:
+            # 本文を読み切っていない接続は状態が不定なので使い回さない
+            if not response.isclosed():
+                _drop_connection(key)
+        return
+    raise HTTPError(url, response.status, "リダイレクト回数の上限を超えました", response.headers, None)
+
 
+@dataclass
+class FetchResult:
+    """fetch_fileの結果。"""
 
-def download_file(name: str, url: str, base: str, ext: str) -> Optional[Path]:
-    """1ファイルをダウンロードし、保存パスを返す（失敗時はNone）。"""
+    path: Path
+    digest: Optional[str] = None  # 保存した本文のハッシュ値（保存しなかった場合はNone）
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    not_modified: bool = False  # 条件付きGETに304が返り、保存済みファイルのままでよい
+
+
+def fetch_file(
+    url: str,
+    parsed: ParseResult,
+    base: str,
+    ext: str,
+    validators: Optional[dict[str, str]] = None,
+) -> FetchResult:
+    """
+    1ファイルをダウンロードして保存する（同名ファイルが既に存在する場合は保存しない）。
+    validatorsを渡すと保存済みファイルの更新確認として条件付きGETを行い、
+    更新されていれば一時ファイルに書き終えてから置き換える。
+    ワーカースレッド上で実行されるため、ログ追記や表示は呼び出し側で行う。
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
     try:
-        req = Request(url, headers={"User-Agent": USER_AGENT})
-        with urlopen(req, timeout=30) as response:
+        with open_url(url, headers) as response:
             content_type = response.headers.get("Content-Type")
-            resolved_ext = ext or guess_extension(url, content_type)
+            resolved_ext = ext or guess_extension(parsed.path, content_type)
             if not resolved_ext.startswith("."):
                 resolved_ext = f".{resolved_ext}"
             target_path = (DOWNLOAD_DIR / f"{base}{resolved_ext}")
-            target_path.parent.mkdir(parents=True, exist_ok=True)
-            if target_path.exists():
-                print(f"[SKIP] {name or base} <- {url} (同名ファイルが既に存在)")
-                append_log(SUCCESS_LOG, target_path.name)
+            if validators is None:
+                write_path, flags = target_path, CREATE_FLAGS
+            else:
+                # 保存済みファイルは一時ファイルに書き終えてから置き換える
+                write_path = target_path.with_name(f"{target_path.name}.part")
+                flags = REPLACE_FLAGS
+            try:
+                # 存在確認と作成を1回のシステムコールで行い、並列タスク間の競合も防ぐ
+                fd = os.open(write_path, flags, 0o644)
+            except FileExistsError:
+                return FetchResult(target_path)
+            digest = hashlib.blake2b(digest_size=16)
+            try:
+                if HAS_FADVISE:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                # 全体をメモリに載せず、チャンク単位でハッシュ計算とファイルへの書き出しを行う
+                with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as fp:
+                    while chunk := response.read(CHUNK_SIZE):
+                        digest.update(chunk)
+                        fp.write(chunk)
+                    if HAS_FADVISE and fp.tell() >= FADVISE_MIN_BYTES:
+                        # 保存した画像を読み返すことはないので、ページキャッシュから外す。
+                        # ダーティなページは捨てられないため、先にディスクへ書き戻しておく
+                        # （同期待ちの方が高くつく小さなファイルはそのままにする）
+                        fp.flush()
+                        os.fdatasync(fd)
+                        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except BaseException:
+                # 途中までのファイルが残ると、次回「同名ファイルが既に存在」と判定されてしまう
+                write_path.unlink(missing_ok=True)
+                raise
+            if write_path != target_path:
+                os.replace(write_path, target_path)
+            return FetchResult(
+                target_path,
+                digest.hexdigest(),
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+    except HTTPError as exc:
+        if validators and exc.code == 304:
+            return FetchResult(DOWNLOAD_DIR / f"{base}{ext}", not_modified=True)
+        raise
+
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# 一時的な通信障害とみなす例外。証明書エラーや名前解決の失敗、不正なスキーム・URLは含めない
+# （RemoteDisconnectedはConnectionErrorとBadStatusLineの両方に当たる）
+RETRY_ERRORS = (
+    TimeoutError, ConnectionError, http.client.IncompleteRead, http.client.BadStatusLine
+)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダー（秒数またはHTTP日付）を待機秒数に変換する（解釈できなければNone）。"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def retry_delay(exc: Exception, attempt: int) -> Optional[float]:
+    """一時的なエラーなら再試行までの待機秒数を、再試行しない場合はNoneを返す。"""
+    if attempt >= MAX_RETRIES:
+        return None
+    backoff = RETRY_BACKOFF_SECONDS * 2 ** attempt
+    if isinstance(exc, HTTPError):
+        if exc.code not in RETRY_STATUSES:
+            return None
+        retry_after = parse_retry_after(exc.headers.get("Retry-After") if exc.headers else None)
+        if retry_after is not None:
+            return min(retry_after, MAX_RETRY_AFTER_SECONDS)
+        return backoff
+    if isinstance(exc, ContentTooShortError):
+        return backoff
+    # URLErrorは元の例外（reason）で判断する
+    reason = exc.reason if isinstance(exc, URLError) else exc
+    if isinstance(reason, RETRY_ERRORS):
+        return backoff
+    return None
+
+
+async def fetch_once(
+    ctx: DownloadContext,
+    url: str,
+    parsed: ParseResult,
+    base: str,
+    ext: str,
+    validators: Optional[dict[str, str]],
+) -> FetchResult:
+    """並列枠とレート制限を守ってfetch_fileを1回呼び出す。"""
+    # 先にホスト枠を確保し、待機中のタスクが全体の枠を占有しないようにする
+    async with ctx.host_semaphore(parsed.netloc), ctx.semaphore:
+        await ctx.bucket.acquire()
+        return await asyncio.to_thread(fetch_file, url, parsed, base, ext, validators)
+
+
+async def download_file(
+    ctx: DownloadContext,
+    name: str,
+    url: str,
+    parsed: ParseResult,
+    base: str,
+    ext: str,
+    validators: Optional[dict[str, str]] = None,
+) -> Optional[Path]:
+    """
+    1ファイルを並列枠の範囲でダウンロードし、保存パスを返す（失敗時・未更新時はNone）。
+    429/5xx応答や通信エラーは、待機時間を倍にしながら（Retry-Afterがあればそれに従い）再試行する。
+    validatorsを渡した場合は保存済みファイルの更新確認として扱う。
+    """
+    attempt = 0
+    while True:
+        try:
+            result = await fetch_once(ctx, url, parsed, base, ext, validators)
+            break
+        except (OSError, http.client.HTTPException) as exc:
+            delay = retry_delay(exc, attempt)
+            if delay is None:
+                retries = f" 再試行{attempt}回" if attempt else ""
+                print(f"[NG] {name or base} <- {url} ({exc}){retries}")
+                append_log(ctx.failed_log, f"{url} ({exc}){retries}")
                 return None
-            with target_path.open("wb") as fp:
-                fp.write(response.read())
-            append_log(SUCCESS_LOG, target_path.name)
-            return target_path
-    except (HTTPError, URLError, ContentTooShortError, TimeoutError) as exc:
-        print(f"[NG] {name or base} <- {url} ({exc})")
-        append_log(FAILED_LOG, f"{url} ({exc})")
+            if isinstance(exc, HTTPError) and exc.code == 429:
+                ctx.bucket.penalize()
+            attempt += 1
+            await asyncio.sleep(delay)
+    target_path, digest = result.path, result.digest
+    if result.not_modified:
+        print(f"[SKIP] {name or base} <- {url} (サーバー上で未更新)")
+        return None
+    if validators is None:
+        record_success(ctx, target_path.name)
+        ctx.existing_names.add(target_path.name)
+    if digest is None:
+        print(f"[SKIP] {name or base} <- {url} (同名ファイルが既に存在)")
         return None
+    if result.etag or result.last_modified:
+        ctx.meta[url] = {
+            "etag": result.etag or "",
+            "last_modified": result.last_modified or "",
+            "path": target_path.name,
+        }
+    else:
+        ctx.meta.pop(url, None)
+    if validators is not None:
+        # 内容が置き換わったので、古い内容のハッシュ値からこのファイルを参照させない
+        for old_digest in [d for d, n in ctx.hash_index.items() if n == target_path.name]:
+            del ctx.hash_index[old_digest]
+    original_name = ctx.hash_index.get(digest)
+    # 削除後に再ダウンロードした場合など、対応表が自分自身を指していればリンクしない
+    if (
+        original_name
+        and original_name != target_path.name
+        and await asyncio.to_thread(
+            link_duplicate, target_path, DOWNLOAD_DIR / original_name, digest
+        )
+    ):
+        print(f"[OK] {name} -> {target_path} ({original_name}と同一内容のためハードリンク)")
+        return target_path
+    ctx.hash_index[digest] = target_path.name
+    print(f"[OK] {name} -> {target_path}")
+    return target_path
 
 
-def iter_csv_rows(csv_path: Path):
-    with csv_path.open("r", newline="", encoding="utf-8") as fp:
-        reader = csv.reader(fp)
-        for row in reader:
-            if not row or len(row) < 2:
-                continue
-            name, url = row[0].strip(), row[1].strip()
-            if not url:
-                continue
-            yield name, url
+def file_digest(path: Path) -> str:
+    """保存済みファイルの本文ハッシュ値（ダウンロード時と同じBLAKE2b）を計算する。"""
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open("rb") as fp:
+        while chunk := fp.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_duplicate(target_path: Path, original_path: Path, digest: str) -> bool:
+    """
+    保存したファイルを同一内容の既存ファイルへのハードリンクに置き換える（失敗時はFalse）。
+    対応表の記録後に既存ファイルが差し替えられている場合に備え、サイズとハッシュ値を確かめてからリンクする。
+    """
+    temp_path = target_path.with_name(f"{target_path.name}.link")
+    try:
+        if os.stat(original_path).st_size != os.stat(target_path).st_size:
+            return False
+        if file_digest(original_path) != digest:
+            return False
+        os.link(original_path, temp_path)
+    except OSError:
+        # 元ファイルが削除済み、またはハードリンク非対応のファイルシステム
+        return False
+    os.replace(temp_path, target_path)
+    return True
+
+
+def load_json(path: Path) -> dict:
+    """ハッシュ値の対応表などのJSONファイルを読み込む（無ければ空の辞書）。"""
+    try:
+        with path.open("r", encoding="utf-8") as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+def save_json(path: Path, data: dict) -> None:
+    """JSONファイルを書き出す（途中で中断しても壊れないよう一時ファイル経由）。"""
+    temp_path = path.with_name(f"{path.name}.tmp")
+    with temp_path.open("w", encoding="utf-8") as fp:
+        json.dump(data, fp, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def load_csv_rows(csv_path: Path) -> list[tuple[str, str]]:
+    """CSVを一括で読み込み、(名称, URL)のリストを返す（列不足・URL空の行は除く）。"""
+    with csv_path.open("rb", buffering=1 << 20) as raw:
+        with io.TextIOWrapper(raw, encoding="utf-8", newline="") as fp:
+            return [
+                (row[0].strip(), url)
+                for row in csv.reader(fp)
+                if len(row) >= 2 and (url := row[1].strip())
+            ]
 
 
 def parse_args() -> argparse.Namespace:
@@ -144,46 +686,120 @@ def parse_args() -> argparse.Namespace:
         default=False,
         help="実際のダウンロードを行わず予定のみ表示する（デフォルトは本番ダウンロード）",
     )
+    parser.add_argument(
+        "--refresh",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="保存済みファイルも条件付きGETで更新を確認し、更新されていれば取得し直す",
+    )
     return parser.parse_args()
 
 
-def main() -> None:
+async def main() -> None:
     if not CSV_PATH.exists():
         raise FileNotFoundError(f"CSV not found: {CSV_PATH}")
 
     args = parse_args()
     dry_run = args.dry_run
+    refresh = args.refresh
+    # 出力先フォルダはここで一度だけ作成し、URLごとの作成確認は行わない
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+    # ブロッキングなダウンロード処理を動かすスレッド数を同時ダウンロード数にそろえ、
+    # スレッドごとの接続プールが必要以上に増えないようにする
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix="download")
+    )
+
+    already_success = load_logged_names(SUCCESS_LOG, SUCCESS_INDEX, write_index=not dry_run)
+    if dry_run and not key_index_is_fresh(SUCCESS_LOG, SUCCESS_INDEX):
+        # 索引を作り直していないので追記せず、次回の実行でsuccess.logから作り直させる
+        success_index: BinaryIO = io.BytesIO()
+    else:
+        success_index = SUCCESS_INDEX.open("ab", buffering=LOG_BUFFER_SIZE)
+    scheduled: set[str] = set()
+    seen_urls: set[str] = set()
+    work: list[tuple[str, str, ParseResult, str, str, Optional[dict[str, str]]]] = []
+
+    # 索引ファイルを最後に閉じ、更新日時がsuccess.log以降になるようにする
+    with (
+        success_index,
+        open_log(SUCCESS_LOG) as success_log,
+        open_log(FAILED_LOG) as failed_log,
+    ):
+        ctx = DownloadContext(
+            asyncio.Semaphore(MAX_CONCURRENCY),
+            TokenBucket(RATE_PER_SECOND, RATE_BURST),
+            scan_existing_names(DOWNLOAD_DIR),
+            success_log,
+            success_index,
+            failed_log,
+            load_json(HASH_INDEX),
+            load_json(META_FILE),
+        )
+
+        rows = load_csv_rows(CSV_PATH)
+        total = len(rows)
+        for name, url in rows:
+            # URLの解析は1行につき1回だけ行い、以降は解析結果を引き回す
+            parsed = urlparse(url)
+            normalized_url = normalize_url(parsed)
+            if normalized_url in seen_urls:
+                print(f"[SKIP] {name} <- {url} (CSV内で重複したURL)")
+                continue
+            seen_urls.add(normalized_url)
+            base, ext = build_base_and_ext(name, parsed.path)
+            candidate_name = f"{base}{ext}"
+            candidate_path = DOWNLOAD_DIR / candidate_name
+            candidate_key = name_key(candidate_name)
+            validators = None
+            if refresh and candidate_name in ctx.existing_names:
+                # 保存済みのファイルは、前回の応答のETag/Last-Modifiedで更新を確認する
+                meta = ctx.meta.get(url)
+                if meta and meta.get("path") == candidate_name:
+                    validators = meta
+            if validators is None:
+                if candidate_key in already_success:
+                    print(f"[SKIP] {name} <- {url} (success.logに記録済みファイル名)")
+                    continue
+                if candidate_name in ctx.existing_names:
+                    print(f"[SKIP] {name} <- {url} (同名ファイルが既に存在)")
+                    record_success(ctx, candidate_name)
+                    already_success.add(candidate_key)
+                    continue
+            elif candidate_key not in already_success:
+                record_success(ctx, candidate_name)
+                already_success.add(candidate_key)
+            if dry_run:
+                note = " (更新確認)" if validators else ""
+                print(f"[DRY-RUN] {name} -> {candidate_path}{note}")
+                continue
+            # 同じ保存先を複数タスクが同時に書き込まないよう、先に予約しておく
+            if candidate_name in scheduled:
+                print(f"[SKIP] {name} <- {url} (同名ファイルをダウンロード予定)")
+                continue
+            scheduled.add(candidate_name)
+            work.append((name, url, parsed, base, ext, validators))
 
-    already_success = load_logged_names(SUCCESS_LOG)
-    total = 0
-    saved = 0
-
-    for total, (name, url) in enumerate(iter_csv_rows(CSV_PATH), start=1):
-        base, ext = build_base_and_ext(name, url)
-        candidate_name = f"{base}{ext}"
-        candidate_path = DOWNLOAD_DIR / candidate_name
-        if candidate_name in already_success:
-            print(f"[SKIP] {name} <- {url} (success.logに記録済みファイル名)")
-            continue
-        if candidate_path.exists():
-            print(f"[SKIP] {name} <- {url} (同名ファイルが既に存在)")
-            append_log(SUCCESS_LOG, candidate_name)
-            already_success.add(candidate_name)
-            continue
-        if dry_run:
-            print(f"[DRY-RUN] {name} -> {candidate_path}")
-            continue
-        path = download_file(name, url, base, ext)
-        if path:
-            saved += 1
-            already_success.add(path.name)
-            print(f"[OK] {name} -> {path}")
-        # 50件ごとに少し長めの休憩を入れる
-        if total % BATCH_PAUSE_EVERY == 0:
-            time.sleep(BATCH_PAUSE_SECONDS)
+        results = await asyncio.gather(
+            *(download_file(ctx, *item) for item in work),
+            return_exceptions=True,
+        )
+        saved = 0
+        for (name, url, *_), result in zip(work, results):
+            if isinstance(result, BaseException):
+                print(f"[NG] {name} <- {url} ({result})")
+                append_log(failed_log, f"{url} ({result})")
+            elif result:
+                saved += 1
+                already_success.add(name_key(result.name))
+        if not dry_run:
+            save_json(HASH_INDEX, ctx.hash_index)
+            save_json(META_FILE, ctx.meta)
 
     print(f"Done. {saved}/{total} files saved.")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())